@@ -15,6 +15,65 @@ NODE_REFRESH_INTERVAL_SECONDS: float = 60.0
 # Path to the admin RPC socket of the validator
 ADMIN_RPC_PATH = "/home/sol/ledger/admin.rpc"
 
+# Traffic classes packets are counted for, mapped to the contact info fields
+# (as returned by getClusterNodes) holding the ports of that class.
+# Ports are taken from the contact infos of the validators on this host and
+# refreshed together with the list of staked nodes. Class names must be
+# usable as nftables identifiers, and there can be at most 7 of them.
+# Traffic to ports not listed here is counted as "other".
+TRAFFIC_CLASSES: dict[str, list[str]] = {
+    "gossip": ["gossip"],
+    "turbine": ["tvu"],
+    "tpu": ["tpu", "tpuQuic", "tpuForwards", "tpuForwardsQuic", "tpuVote"],
+    "repair": ["serveRepair"],
+}
+# How much seeing traffic of a given class from a node counts towards that node being
+# reachable. Weights of classes with traffic are summed and capped at 1, so any single
+# class with weight 1 is enough for the node to count as reachable. This can not express
+# "needs both turbine AND tpu", use weights of 0.5 on both to give partial credit instead.
+# "other" covers traffic to unknown ports, which is all traffic if the ports of
+# the local validator could not be found.
+# With all weights at 1 any packet counts, same as before traffic classes existed.
+# Setting gossip to 0 makes nodes which only send gossip count as unreachable. This is
+# opt-in: outside of our leader slots most nodes send no TPU traffic and only our
+# turbine parents send shreds, so reachable stake will be lower. Lower STAKE_THRESHOLD
+# according to what you observe on a healthy link before doing so.
+TRAFFIC_CLASS_WEIGHTS: dict[str, float] = {
+    "gossip": 1.0,
+    "turbine": 1.0,
+    "tpu": 1.0,
+    "repair": 1.0,
+    "other": 1.0,
+}
+
+# Directory holding the status page and query socket, created if missing.
+# It must not be writable by other users since the monitor usually runs as root.
+# When running as an unpriviledged user, pick a directory that user can write to.
+RUNTIME_DIR = "/run/doublezero_monitor"
+# Memory-mapped status page for external consumers, see status.py for layout
+STATUS_PAGE_PATH = RUNTIME_DIR + "/status"
+# Unix socket serving per-node detail as JSON, see status.py
+QUERY_SOCKET_PATH = RUNTIME_DIR + "/query.sock"
+# Connecting to the socket needs write permission on it. Members of this group
+# (e.g. the user running the validator) may query it, None keeps the daemon's group.
+QUERY_SOCKET_GROUP = "sol"
+QUERY_SOCKET_MODE = 0o660
+# Readers treat the status page as stale when it was not updated for this long
+STATUS_PAGE_MAX_AGE_SECONDS: float = 60.0
+
+# Directory for the binary health journal, query it with journal.py
+JOURNAL_DIR = "/home/sol/doublezero_monitor_journal"
+# Journal segments are rotated at this size, oldest are deleted beyond JOURNAL_MAX_FILES.
+# Every tick takes 3 bytes plus 16 per traffic class seen for each node with traffic,
+# about 40 bytes for a typical node, so with ~1000 staked nodes the 8 GiB below hold
+# about 2.5 days of history for monitor.py (a tick per second per instance) and about
+# 17 days for monitor_ibrl.py (a tick every PASSIVE_MONITORING_INTERVAL_SECONDS).
+# Scale JOURNAL_MAX_FILES to what you need.
+JOURNAL_MAX_FILE_BYTES = 64 * 1024 * 1024
+JOURNAL_MAX_FILES = 128
+# How often buffered journal records are written to disk
+JOURNAL_FLUSH_INTERVAL_SECONDS: float = 5.0
+
 # Parameters below you should probably not tune
 
 # Table to create in nftables
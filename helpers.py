@@ -1,10 +1,12 @@
 import asyncio
+import dataclasses
 import ipaddress
 import subprocess
 from traceback import print_exc
 import json
 import os
-from typing import Any
+import socket
+from typing import Any, Optional
 from config import *
 from urllib import request
 
@@ -12,14 +14,59 @@ from urllib import request
 SUDO = "" if os.geteuid() == 0 else "sudo "
 
 
-def nft_add_table():
-    cmd = f"{SUDO}nft add table inet {NFT_TABLE}"
-    _ = subprocess.check_call(cmd.split(" "))
-    cmd = (
-        f"{SUDO}nft add chain inet {NFT_TABLE} "
-        + r" input { type filter hook input priority 0 \; }"
+# Counter counting all traffic from a node, regardless of destination port
+ALL_TRAFFIC = "all"
+# Traffic not matching any of TRAFFIC_CLASSES, derived from ALL_TRAFFIC
+OTHER_TRAFFIC = "other"
+
+
+def nft_run(script: str) -> bool:
+    """Apply an nft script atomically, returns False (and prints why) if it failed"""
+    proc = subprocess.run(
+        SUDO.split() + ["nft", "-f", "-"], input=script, capture_output=True, text=True
     )
-    _ = subprocess.check_call(cmd, shell=True)
+    if proc.returncode != 0:
+        print(f"nft failed: {proc.stderr.strip()}")
+    return proc.returncode == 0
+
+
+def _nft_key(by_dest: bool) -> tuple[str, str]:
+    """Type and expression of keys in counter maps"""
+    if by_dest:
+        return "ipv4_addr . ipv4_addr", "ip saddr . ip daddr"
+    return "ipv4_addr", "ip saddr"
+
+
+def nft_add_table(by_dest: bool) -> None:
+    """
+    Create table with one counter map per traffic class keyed by source IP
+    (and destination IP if by_dest). Every packet is looked up in a port set
+    and a counter map per class, so the cost per packet does not depend on
+    the number of monitored nodes.
+    """
+    # one bit per class and one for "other" in the journal
+    if len(TRAFFIC_CLASSES) > 7:
+        raise ValueError("At most 7 traffic classes are supported")
+    for cls in TRAFFIC_CLASSES:
+        if not cls.isidentifier():
+            raise ValueError(f"Traffic class name {cls!r} is not a valid identifier")
+    key_type, key_expr = _nft_key(by_dest)
+    # adding before deleting makes sure the table exists, so leftovers of an
+    # unclean exit (possibly with different key types) are always cleared
+    script = f"""add table inet {NFT_TABLE}
+delete table inet {NFT_TABLE}
+add table inet {NFT_TABLE}
+add chain inet {NFT_TABLE} input {{ type filter hook input priority 0 ; }}
+add map inet {NFT_TABLE} counters_{ALL_TRAFFIC} {{ type {key_type} : counter ; }}
+add rule inet {NFT_TABLE} input counter name {key_expr} map @counters_{ALL_TRAFFIC}
+"""
+    for cls in TRAFFIC_CLASSES:
+        script += f"""add set inet {NFT_TABLE} ports_{cls} {{ type inet_service ; }}
+add map inet {NFT_TABLE} counters_{cls} {{ type {key_type} : counter ; }}
+add rule inet {NFT_TABLE} input udp dport @ports_{cls} counter name {key_expr} map @counters_{cls}
+"""
+    if not nft_run(script):
+        raise RuntimeError("Could not set up nftables")
 
 
 def nft_drop_table():
@@ -27,36 +74,118 @@ def nft_drop_table():
     _ = subprocess.call(cmd.split(" "))
 
 
-def get_nft_counters() -> dict[ipaddress.IPv4Address, int]:
-    cmd = f"{SUDO}nft -j list chain inet {NFT_TABLE} input"
-    counters: dict[ipaddress.IPv4Address, int] = {}
+def nft_set_ports(ports: dict[str, set[int]]) -> None:
+    """Replace destination ports matched by each traffic class"""
+    script = ""
+    for cls in TRAFFIC_CLASSES:
+        script += f"flush set inet {NFT_TABLE} ports_{cls}\n"
+        if ports.get(cls):
+            elements = ", ".join(str(p) for p in sorted(ports[cls]))
+            script += f"add element inet {NFT_TABLE} ports_{cls} {{ {elements} }}\n"
+    nft_run(script)
+
+
+@dataclasses.dataclass
+class Counter:
+    packets: int = 0
+    bytes: int = 0
+
+    def __add__(self, other: "Counter") -> "Counter":
+        return Counter(self.packets + other.packets, self.bytes + other.bytes)
+
+    def __sub__(self, other: "Counter") -> "Counter":
+        return Counter(self.packets - other.packets, self.bytes - other.bytes)
+
+
+def format_traffic_rates(rates: dict[str, tuple[float, float]]) -> str:
+    return ", ".join(
+        f"{cls} {pps:.0f} pkt/s {bps / 1e6:.2f} MB/s"
+        for cls, (pps, bps) in rates.items()
+    )
+
+
+# Counters are keyed by (source IP, destination IP, traffic class).
+# Destination is None for counters that match traffic to any local address,
+# traffic class is ALL_TRAFFIC or one of TRAFFIC_CLASSES.
+CounterKey = tuple[ipaddress.IPv4Address, Optional[ipaddress.IPv4Address], str]
+
+
+def _counter_name(
+    ip: ipaddress.IPv4Address, dest: Optional[ipaddress.IPv4Address], cls: str
+) -> str:
+    dest_name = "any" if dest is None else str(dest).replace(".", "_")
+    return f"c_{str(ip).replace('.', '_')}_{dest_name}_{cls}"
+
+
+def _parse_counter_name(name: str) -> Optional[CounterKey]:
+    parts = name.split("_")
+    if parts[0] != "c" or len(parts) < 7:
+        return None
+    source = ipaddress.IPv4Address(".".join(parts[1:5]))
+    if parts[5] == "any":
+        return (source, None, "_".join(parts[6:]))
+    return (
+        source,
+        ipaddress.IPv4Address(".".join(parts[5:9])),
+        "_".join(parts[9:]),
+    )
+
+
+def get_nft_counters() -> dict[CounterKey, Counter]:
+    cmd = f"{SUDO}nft -j list counters table inet {NFT_TABLE}"
+    counters: dict[CounterKey, Counter] = {}
     try:
         (_status, output) = subprocess.getstatusoutput(cmd)
         x = json.loads(output)
         for row in x["nftables"]:
-            if "rule" not in row:
+            if "counter" not in row:
                 continue
-            expr = row["rule"]["expr"]
-            source = ipaddress.IPv4Address(expr[0]["match"]["right"])
-            counters[source] = expr[1]["counter"]["packets"]
+            key = _parse_counter_name(row["counter"]["name"])
+            if key is not None:
+                counters[key] = Counter(
+                    row["counter"]["packets"], row["counter"]["bytes"]
+                )
     except:
         print_exc()
     finally:
         return counters
 
 
-def nft_add_counter(ip: ipaddress.IPv4Address)->None:
-    cmd = f"{SUDO}nft add rule inet {NFT_TABLE} input ip saddr {ip} counter"
-    (_status, _output) = subprocess.getstatusoutput(cmd)
+def _counter_elements(
+    ip: ipaddress.IPv4Address, dest: Optional[ipaddress.IPv4Address]
+) -> list[tuple[str, str, str]]:
+    """(class, map key, counter name) for every counter of given source and destination"""
+    key = str(ip) if dest is None else f"{ip} . {dest}"
+    return [
+        (cls, key, _counter_name(ip, dest, cls))
+        for cls in [ALL_TRAFFIC, *TRAFFIC_CLASSES]
+    ]
+
+
+def nft_add_counter(
+    ip: ipaddress.IPv4Address, dest: Optional[ipaddress.IPv4Address] = None
+) -> None:
+    """Add counters for traffic from ip (to dest), one per traffic class"""
+    script = ""
+    for cls, key, name in _counter_elements(ip, dest):
+        script += f"add counter inet {NFT_TABLE} {name}\n"
+        script += f"add element inet {NFT_TABLE} counters_{cls} {{ {key} : {name} }}\n"
+    nft_run(script)
+
+
+def nft_del_counter(
+    ip: ipaddress.IPv4Address, dest: Optional[ipaddress.IPv4Address] = None
+) -> None:
+    """Delete counters added by nft_add_counter"""
+    elements = _counter_elements(ip, dest)
+    script = ""
+    # map elements reference the counters, so they have to go first
+    for cls, key, _name in elements:
+        script += f"delete element inet {NFT_TABLE} counters_{cls} {{ {key} }}\n"
+    for _cls, _key, name in elements:
+        script += f"delete counter inet {NFT_TABLE} {name}\n"
+    nft_run(script)
 
-def nft_del_counter(ip: ipaddress.IPv4Address)->None:
-    cmd = f"{SUDO}nft -a list chain inet {NFT_TABLE} input"
-    (_status, output) = subprocess.getstatusoutput(cmd)
-    for line in output.splitlines():
-        if str(ip) in line:
-            handle = line.split("# handle")[1]
-            cmd = f"{SUDO}nft delete rule inet {NFT_TABLE} input handle {handle}"
-            (_status, _output) = subprocess.getstatusoutput(cmd)
 
 async def get_staked_nodes() -> dict[str, int]:
     output = await get_from_RPC("getVoteAccounts")
@@ -67,15 +196,53 @@ async def get_staked_nodes() -> dict[str, int]:
     }
 
 
-async def get_contact_infos() -> dict[str, ipaddress.IPv4Address]:
-    output = await get_from_RPC("getClusterNodes")
+async def get_cluster_nodes() -> list[dict[str, Any]]:
+    return await get_from_RPC("getClusterNodes")
+
+
+def get_contact_infos(
+    cluster_nodes: list[dict[str, Any]],
+) -> dict[str, ipaddress.IPv4Address]:
     return {
         v["pubkey"]: ipaddress.IPv4Address(v["tpuQuic"].split(":")[0])
-        for v in output
+        for v in cluster_nodes
         if v.get("tpuQuic") is not None
     }
 
 
+def get_local_ports(
+    cluster_nodes: list[dict[str, Any]], local_ips: set[ipaddress.IPv4Address]
+) -> Optional[dict[str, set[int]]]:
+    """
+    Ports of each traffic class used by the validators on this host,
+    taken from their own contact infos (nodes gossiping from one of local_ips).
+    Returns None if none of the local validators were found.
+    """
+    ports: dict[str, set[int]] = {cls: set() for cls in TRAFFIC_CLASSES}
+    found = False
+    for v in cluster_nodes:
+        gossip = v.get("gossip")
+        if gossip is None:
+            continue
+        if ipaddress.IPv4Address(gossip.rsplit(":", 1)[0]) not in local_ips:
+            continue
+        found = True
+        for cls, fields in TRAFFIC_CLASSES.items():
+            for field in fields:
+                if v.get(field) is not None:
+                    ports[cls].add(int(v[field].rsplit(":", 1)[1]))
+    return ports if found else None
+
+
+def get_default_ip() -> ipaddress.IPv4Address:
+    # Doesn't actually connect — just figures out the outbound IP
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect(("8.8.8.8", 80))  # Google DNS
+    ip = ipaddress.IPv4Address(s.getsockname()[0])
+    s.close()
+    return ip
+
+
 def kill_dz_interface() -> None:
     _ = subprocess.call(f"{SUDO}ip link set doublezero0 down", shell=True)
 
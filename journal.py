@@ -0,0 +1,520 @@
+#!/usr/bin/python3
+"""
+Binary append-only health journal and tools to query it.
+
+Journal is a directory of segments named by the unix time (in milliseconds)
+they were started at. Each segment consists of two files: "<start>.dzj" holds
+the per-tick traffic data and the much smaller "<start>.dzi" holds only the
+records marking changes, so looking for those never has to touch tick data.
+Both start with magic "DZJ2" followed by records (little endian):
+
+    header: u8 record type, u32 payload length, f64 timestamp
+    NODE:       u16 node index, 4s IPv4 address, u64 stake, pubkey (rest of payload)
+    INSTANCE:   u8 instance index, name (rest of payload)
+    CLASSES:    comma separated traffic class names, in bit order of TICK masks
+    TICK:       u8 instance index, f32 reachable stake fraction,
+                then per node with traffic: u16 node index, u8 mask of traffic
+                classes with traffic, then u64 packets, u64 bytes for each class
+                in the mask
+    TRANSITION: u8 instance index, u8 1 if nodes became unreachable / 0 if they
+                came back, then u16 node indexes
+    EVENT:      u8 instance index, decision reason (rest of payload)
+
+NODE, INSTANCE and CLASSES records define what the others refer to, they are
+repeated in each file so that every file can be read on its own. Node and
+instance indexes are stable for the life of the daemon. TICK records go into
+.dzj files, TRANSITION and EVENT records into .dzi files.
+
+A node counts as unreachable while its reachability score (see
+SharedState.reachability) is below 1, the same way the monitors count it.
+Nodes without any traffic are omitted from TICK records.
+
+Records are buffered in memory and written in batches from a worker thread,
+segments are rotated once they reach JOURNAL_MAX_FILE_BYTES. The journal is
+diagnostics only: errors writing it are printed and never stop the monitor.
+"""
+import argparse
+import asyncio
+import collections
+import dataclasses
+import ipaddress
+import mmap
+import os
+import struct
+import time
+from collections.abc import Iterator
+from traceback import print_exc
+from typing import Optional
+from config import *
+from helpers import *
+from shared import SharedState, StakedNode
+
+MAGIC = b"DZJ2"
+DATA_EXT = ".dzj"
+INDEX_EXT = ".dzi"
+
+NODE = 1
+INSTANCE = 2
+TICK = 3
+TRANSITION = 4
+EVENT = 5
+CLASSES = 6
+# records which go into the index file of a segment
+INDEX_KINDS = {TRANSITION, EVENT}
+
+HEADER = struct.Struct("<BId")
+NODE_DEF = struct.Struct("<H4sQ")
+INSTANCE_DEF = struct.Struct("<B")
+TICK_HEAD = struct.Struct("<Bf")
+TICK_ENTRY = struct.Struct("<HB")
+TICK_CLASS = struct.Struct("<QQ")
+TRANSITION_HEAD = struct.Struct("<BB")
+NODE_INDEX = struct.Struct("<H")
+
+
+def _append(path: str, data: bytes) -> None:
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def _prune(directory: str, max_segments: int) -> None:
+    segments = journal_segments(directory)
+    for segment in segments[: max(0, len(segments) - max_segments)]:
+        for ext in (DATA_EXT, INDEX_EXT):
+            try:
+                os.unlink(segment + ext)
+            except FileNotFoundError:
+                pass
+
+
+def journal_segments(directory: str) -> list[str]:
+    """Paths of journal segments without extension, in the order they were written"""
+    if not os.path.isdir(directory):
+        return []
+    starts: set[int] = set()
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        # ignore anything else which may have ended up in the directory
+        if ext in (DATA_EXT, INDEX_EXT) and stem.isdigit():
+            starts.add(int(stem))
+    return [os.path.join(directory, str(start)) for start in sorted(starts)]
+
+
+class _Output:
+    """One file of the current segment with its buffered records"""
+
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.buf = bytearray(MAGIC)
+        # definitions already written into this file
+        self.defined_nodes: set[str] = set()
+        self.defined_instances: set[str] = set()
+
+
+class Journal:
+    """Writer side of the health journal"""
+
+    directory: str
+    max_file_bytes: int = JOURNAL_MAX_FILE_BYTES
+    max_files: int = JOURNAL_MAX_FILES
+    flush_interval_seconds: float = JOURNAL_FLUSH_INTERVAL_SECONDS
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        # set to False if the journal directory could not be created
+        self.enabled = True
+        self._size = 0
+        self._nodes: dict[str, int] = {}
+        self._instances: dict[str, int] = {}
+        self._classes = list(TRAFFIC_CLASSES) + [OTHER_TRAFFIC]
+        self._data = _Output("")
+        self._index = _Output("")
+        # nodes currently considered unreachable per instance
+        self._silent: dict[str, set[str]] = {}
+
+    def __enter__(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            print(f"Could not create journal directory, journal disabled, error {e}")
+            self.enabled = False
+            return self
+        self._start_segment()
+        print(f"Writing health journal to {self.directory}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+        for out in (self._data, self._index):
+            try:
+                _append(out.path, bytes(out.buf))
+            except OSError as e:
+                print(f"Could not write journal, error {e}")
+            out.buf.clear()
+
+    def _start_segment(self) -> None:
+        segment = os.path.join(self.directory, str(int(time.time() * 1000)))
+        self._size = 0
+        self._data = _Output(segment + DATA_EXT)
+        self._index = _Output(segment + INDEX_EXT)
+        self._record(
+            self._data, CLASSES, ",".join(self._classes).encode(), time.time()
+        )
+
+    def _record(self, out: _Output, kind: int, payload: bytes, timestamp: float) -> None:
+        out.buf += HEADER.pack(kind, len(payload), timestamp)
+        out.buf += payload
+
+    def _instance_index(self, out: _Output, name: str, timestamp: float) -> int:
+        idx = self._instances.setdefault(name, len(self._instances))
+        if name not in out.defined_instances:
+            out.defined_instances.add(name)
+            self._record(
+                out, INSTANCE, INSTANCE_DEF.pack(idx) + name.encode(), timestamp
+            )
+        return idx
+
+    def _node_index(self, out: _Output, node: StakedNode, timestamp: float) -> int:
+        idx = self._nodes.setdefault(node.pubkey, len(self._nodes))
+        if node.pubkey not in out.defined_nodes:
+            out.defined_nodes.add(node.pubkey)
+            self._record(
+                out,
+                NODE,
+                NODE_DEF.pack(idx, node.ip_address.packed, node.stake)
+                + node.pubkey.encode(),
+                timestamp,
+            )
+        return idx
+
+    def tick(
+        self,
+        instance: str,
+        reachable_stake_fraction: float,
+        shared: SharedState,
+        dest: Optional[ipaddress.IPv4Address] = None,
+        nodes: Optional[list[StakedNode]] = None,
+    ) -> None:
+        """Record counter deltas of the last interval for given instance"""
+        if not self.enabled:
+            return
+        try:
+            self._tick(instance, reachable_stake_fraction, shared, dest, nodes)
+        except Exception:
+            print_exc()
+
+    def _tick(
+        self,
+        instance: str,
+        reachable_stake_fraction: float,
+        shared: SharedState,
+        dest: Optional[ipaddress.IPv4Address],
+        nodes: Optional[list[StakedNode]],
+    ) -> None:
+        now = time.time()
+        inst = self._instance_index(self._data, instance, now)
+        if nodes is None:
+            nodes = list(shared.staked_nodes.values())
+        entries = bytearray()
+        silent: set[str] = set()
+        for node in nodes:
+            if shared.reachability(node, dest) < 1.0:
+                silent.add(node.pubkey)
+            traffic = shared.traffic_from(node, dest)
+            mask = 0
+            values = bytearray()
+            for bit, cls in enumerate(self._classes):
+                cnt = traffic.get(cls, Counter())
+                # deltas may be off after a failed counter read, never let that break packing
+                if cnt.packets > 0 or cnt.bytes > 0:
+                    mask |= 1 << bit
+                    values += TICK_CLASS.pack(max(0, cnt.packets), max(0, cnt.bytes))
+            if mask:
+                entries += TICK_ENTRY.pack(self._node_index(self._data, node, now), mask)
+                entries += values
+        self._record(
+            self._data,
+            TICK,
+            TICK_HEAD.pack(inst, reachable_stake_fraction) + entries,
+            now,
+        )
+
+        prev = self._silent.get(instance, set())
+        by_pubkey = {node.pubkey: node for node in nodes}
+        for went_silent, changed in ((1, silent - prev), (0, prev - silent)):
+            changed &= by_pubkey.keys()
+            if not changed:
+                continue
+            inst = self._instance_index(self._index, instance, now)
+            payload = TRANSITION_HEAD.pack(inst, went_silent) + b"".join(
+                NODE_INDEX.pack(self._node_index(self._index, by_pubkey[pk], now))
+                for pk in changed
+            )
+            self._record(self._index, TRANSITION, payload, now)
+        self._silent[instance] = silent
+
+    def event(self, instance: str, reason: str) -> None:
+        """Record a decision made by given instance"""
+        if not self.enabled:
+            return
+        try:
+            now = time.time()
+            inst = self._instance_index(self._index, instance, now)
+            self._record(
+                self._index, EVENT, INSTANCE_DEF.pack(inst) + reason.encode(), now
+            )
+        except Exception:
+            print_exc()
+
+    async def flush(self) -> None:
+        if not self.enabled:
+            return
+        outputs = [
+            (out.path, bytes(out.buf)) for out in (self._data, self._index) if out.buf
+        ]
+        if not outputs:
+            return
+        written = sum(len(data) for _path, data in outputs)
+        self._data.buf.clear()
+        self._index.buf.clear()
+        self._size += written
+        # rotate before anything else is recorded so new records
+        # get their definitions repeated in the new segment
+        rotate = self._size >= self.max_file_bytes
+        if rotate:
+            self._start_segment()
+        loop = asyncio.get_event_loop()
+        try:
+            for path, data in outputs:
+                await loop.run_in_executor(None, _append, path, data)
+            if rotate:
+                # current segment is not on disk yet, leave room for it
+                await loop.run_in_executor(
+                    None, _prune, self.directory, self.max_files - 1
+                )
+        except Exception as e:
+            print(f"Could not write journal, dropping {written} bytes, error {e}")
+            if not rotate:
+                # definitions written into the lost data are gone, so records
+                # buffered since then can not be decoded, start a new segment instead
+                self._start_segment()
+
+    async def main(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                print_exc()
+
+
+@dataclasses.dataclass
+class NodeInfo:
+    pubkey: str
+    ip_address: ipaddress.IPv4Address
+    stake: int
+
+
+@dataclasses.dataclass
+class Record:
+    kind: int
+    timestamp: float
+    payload: bytes
+
+
+class JournalReader:
+    """Memory-maps journal files and decodes only the records asked for"""
+
+    def __init__(self, directory: str) -> None:
+        self.segments = journal_segments(directory)
+        self.nodes: dict[int, NodeInfo] = {}
+        self.instances: dict[int, str] = {}
+        self.classes: list[str] = []
+
+    def records(
+        self, kinds: set[int], since: float = 0.0, until: float = float("inf")
+    ) -> Iterator[Record]:
+        """
+        Records of given kinds within time range. Definitions are those of the file
+        the last record came from, so resolve node and instance indexes right away.
+        """
+        # transitions and events are in the index files, which hold no tick data
+        ext = INDEX_EXT if kinds <= INDEX_KINDS else DATA_EXT
+        for n, segment in enumerate(self.segments):
+            # segments are named by their start time, so we can skip whole segments
+            if file_start(segment) > until:
+                break
+            # every file carries its own definitions, so older ones need not be read
+            if n + 1 < len(self.segments) and file_start(self.segments[n + 1]) < since:
+                continue
+            yield from self._read_file(segment + ext, kinds, since, until)
+
+    def _read_file(
+        self, path: str, kinds: set[int], since: float, until: float
+    ) -> Iterator[Record]:
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size <= len(MAGIC):
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm[: len(MAGIC)] != MAGIC:
+                print(f"Skipping {path}: not a journal file of this version")
+                return
+            offset = len(MAGIC)
+            size = len(mm)
+            while offset + HEADER.size <= size:
+                kind, length, ts = HEADER.unpack_from(mm, offset)
+                offset += HEADER.size
+                if offset + length > size:
+                    # partially written record at the end of the file
+                    break
+                if kind == NODE:
+                    idx, ip, stake = NODE_DEF.unpack_from(mm, offset)
+                    self.nodes[idx] = NodeInfo(
+                        pubkey=mm[offset + NODE_DEF.size : offset + length].decode(),
+                        ip_address=ipaddress.IPv4Address(ip),
+                        stake=stake,
+                    )
+                elif kind == INSTANCE:
+                    (idx,) = INSTANCE_DEF.unpack_from(mm, offset)
+                    self.instances[idx] = mm[
+                        offset + INSTANCE_DEF.size : offset + length
+                    ].decode()
+                elif kind == CLASSES:
+                    self.classes = mm[offset : offset + length].decode().split(",")
+                elif kind in kinds and since <= ts <= until:
+                    yield Record(kind, ts, mm[offset : offset + length])
+                offset += length
+        finally:
+            mm.close()
+
+    def instance_of(self, rec: Record) -> str:
+        return self.instances.get(rec.payload[0], "?")
+
+    def tick_entries(self, rec: Record) -> Iterator[tuple[int, dict[str, Counter]]]:
+        """Node index and traffic per class of every node in a TICK record"""
+        offset = TICK_HEAD.size
+        while offset + TICK_ENTRY.size <= len(rec.payload):
+            idx, mask = TICK_ENTRY.unpack_from(rec.payload, offset)
+            offset += TICK_ENTRY.size
+            traffic: dict[str, Counter] = {}
+            for bit in range(8):
+                if mask & (1 << bit):
+                    packets, nbytes = TICK_CLASS.unpack_from(rec.payload, offset)
+                    offset += TICK_CLASS.size
+                    cls = self.classes[bit] if bit < len(self.classes) else f"#{bit}"
+                    traffic[cls] = Counter(packets=packets, bytes=nbytes)
+            yield idx, traffic
+
+
+def query_silent(
+    reader: JournalReader, since: float, until: float, limit: int, instance: Optional[str]
+) -> None:
+    """Print the last transitions of nodes becoming unreachable or coming back"""
+    # only keep the most recent ones, decoded while their definitions are current
+    lines: collections.deque[list[str]] = collections.deque(maxlen=limit)
+    cumulative = 0
+    for rec in reader.records({TRANSITION}, since, until):
+        inst = reader.instance_of(rec)
+        if instance is not None and inst != instance:
+            continue
+        _inst, went_silent = TRANSITION_HEAD.unpack_from(rec.payload)
+        indexes = [
+            i for (i,) in NODE_INDEX.iter_unpack(rec.payload[TRANSITION_HEAD.size :])
+        ]
+        nodes = sorted(
+            (reader.nodes[i] for i in indexes if i in reader.nodes),
+            key=lambda n: n.stake,
+            reverse=True,
+        )
+        stake = sum(n.stake for n in nodes)
+        cumulative += stake if went_silent else -stake
+        state = "became unreachable" if went_silent else "came back"
+        lines.append(
+            [
+                f"{format_time(rec.timestamp)} [{inst}] {len(nodes)} nodes with {stake / LAMPORTS_PER_SOL:.0f} SOL {state} (unreachable total {cumulative / LAMPORTS_PER_SOL:.0f} SOL)"
+            ]
+            + [
+                f"    {node.pubkey} {node.ip_address} {node.stake / LAMPORTS_PER_SOL:.0f} SOL"
+                for node in nodes
+            ]
+        )
+    for group in lines:
+        print("\n".join(group))
+
+
+def query_events(reader: JournalReader, since: float, until: float, limit: int) -> None:
+    """Print the last decision events"""
+    lines: collections.deque[str] = collections.deque(maxlen=limit)
+    for rec in reader.records({EVENT}, since, until):
+        reason = rec.payload[INSTANCE_DEF.size :].decode()
+        lines.append(f"{format_time(rec.timestamp)} [{reader.instance_of(rec)}] {reason}")
+    for line in lines:
+        print(line)
+
+
+def query_ticks(reader: JournalReader, since: float, until: float, below: float) -> None:
+    """Print ticks where reachable stake fraction was below given value"""
+    for rec in reader.records({TICK}, since, until):
+        _inst, fraction = TICK_HEAD.unpack_from(rec.payload)
+        if fraction < below:
+            nodes = 0
+            totals: dict[str, Counter] = {}
+            for _idx, traffic in reader.tick_entries(rec):
+                nodes += 1
+                for cls, cnt in traffic.items():
+                    totals[cls] = totals.get(cls, Counter()) + cnt
+            per_class = ", ".join(
+                f"{cls} {cnt.packets} pkts/{cnt.bytes} B" for cls, cnt in totals.items()
+            )
+            print(
+                f"{format_time(rec.timestamp)} [{reader.instance_of(rec)}] reachable stake {fraction:.1%}, {nodes} nodes with traffic: {per_class}"
+            )
+
+
+def file_start(path: str) -> float:
+    return int(os.path.basename(path).split(".")[0]) / 1000
+
+
+def format_time(ts: float) -> str:
+    millis = int(ts * 1000) % 1000
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) + f".{millis:03d}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the health journal")
+    parser.add_argument("--dir", default=JOURNAL_DIR, help="journal directory")
+    parser.add_argument("--since", type=float, default=0.0, help="unix timestamp")
+    parser.add_argument(
+        "--until", type=float, default=float("inf"), help="unix timestamp"
+    )
+    parser.add_argument(
+        "--last", type=float, help="only look at the last given number of seconds"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    silent = sub.add_parser(
+        "silent", help="which stake became unreachable first, and when"
+    )
+    silent.add_argument("-n", type=int, default=10, help="number of last transitions")
+    silent.add_argument("--instance", help="only show given instance")
+    events = sub.add_parser("events", help="decisions made by the monitor")
+    events.add_argument("-n", type=int, default=20, help="number of last events")
+    ticks = sub.add_parser("ticks", help="ticks with low reachable stake")
+    ticks.add_argument("--below", type=float, default=STAKE_THRESHOLD)
+    args = parser.parse_args()
+
+    since = time.time() - args.last if args.last is not None else args.since
+    reader = JournalReader(args.dir)
+    if args.command == "silent":
+        query_silent(reader, since, args.until, args.n, args.instance)
+    elif args.command == "events":
+        query_events(reader, since, args.until, args.n)
+    elif args.command == "ticks":
+        query_ticks(reader, since, args.until, args.below)
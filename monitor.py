@@ -4,44 +4,43 @@ import json
 import ipaddress
 import asyncio
 import dataclasses
-import socket
-import ping
 import time
+from traceback import print_exc
+from typing import Optional
 from doublezero import doublezero_is_active
 import task_group
 from config import *
 from helpers import *
-
-
-def get_config() -> list["Connection"]:
-    """List the connection options. These must match what you have specified in --bind-address to the validator"""
-    connections = [
-        Connection(name="Public Internet", ip_address=get_default_ip()),
-        DoubleZeroConnection(
-            name="DoubleZero",
-            ip_address=get_default_ip(),
-            use_active_monitoring=True,
-            preference=100,
+from journal import Journal
+from shared import SharedState
+from status import (
+    InstanceStatus,
+    QueryServer,
+    StatusPage,
+    connection_status,
+    publish_status,
+)
+
+
+def get_config() -> list["Monitor"]:
+    """List the monitored validator instances on this host and their connection options.
+    Connections must match what you have specified in --bind-address to each validator"""
+    instances = [
+        Monitor(
+            name="validator",
+            admin_rpc_path=ADMIN_RPC_PATH,
+            connections=[
+                Connection(name="Public Internet", ip_address=get_default_ip()),
+                DoubleZeroConnection(
+                    name="DoubleZero",
+                    ip_address=get_default_ip(),
+                    use_active_monitoring=True,
+                    preference=100,
+                ),
+            ],
         ),
     ]
-    return connections
-
-
-def get_default_ip() -> ipaddress.IPv4Address:
-    # Doesn't actually connect — just figures out the outbound IP
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(("8.8.8.8", 80))  # Google DNS
-    ip = ipaddress.IPv4Address(s.getsockname()[0])
-    s.close()
-    return ip
-
-
-@dataclasses.dataclass
-class StakedNode:
-    pubkey: str
-    ip_address: ipaddress.IPv4Address
-    stake: int
-    packet_count: int
+    return instances
 
 
 @dataclasses.dataclass
@@ -108,12 +107,17 @@ class DoubleZeroConnection(Connection):
 
 
 class Monitor:
-    staked_nodes: dict[str, StakedNode] = {}
+    """Monitors and switches connections of one validator instance on the host"""
+
+    name: str
     connection: Connection
     connections: list[Connection]
+    admin_rpc_path: str
+    # last decision made and when it was first made, published on the status page
+    decision_reason: str = "Warming up"
+    decision_timestamp: float
+    journal: Optional[Journal] = None
     decision_check_interval_seconds: float = 1.0
-    passive_monitoring_interval_seconds: float = 1.0
-    active_monitoring_interval_seconds: float = 10.0
     # how long do we wait before consindering connection dead
     grace_period_sec: float = 2.0
     # how long do we wait before switching back to a connection that was not used
@@ -122,92 +126,127 @@ class Monitor:
     stake_threshold: float = 0.9
     # how long time to keep a particular connection after switch is made
     switch_debounce_seconds: float = 60.0
-    # Interval between refreshes of gossip tables via RPC
-    node_refresh_interval_seconds: float = 60.0
-
-    def __init__(self, connections: list[Connection]) -> None:
+    # how long to wait for the validator to answer admin RPC
+    admin_rpc_timeout_seconds: float = 5.0
+
+    def __init__(
+        self,
+        name: str,
+        connections: list[Connection],
+        admin_rpc_path: str = ADMIN_RPC_PATH,
+        stake_threshold: Optional[float] = None,
+        grace_period_sec: Optional[float] = None,
+    ) -> None:
+        self.name = name
         self.connections = connections
-        print(f"Starting monitoring with connections: {connections}")
+        self.admin_rpc_path = admin_rpc_path
+        if stake_threshold is not None:
+            self.stake_threshold = stake_threshold
+        if grace_period_sec is not None:
+            self.grace_period_sec = grace_period_sec
+        print(f"[{name}] Starting monitoring with connections: {connections}")
         self.connection = connections[0]
-
-    def __enter__(self):
-        print("Setting up nftables")
-        nft_add_table()
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        print("Cleaning up")
-        nft_drop_table()
-
-    async def refresh_staked_nodes(self):
-        """
-        Refresh list of staked nodes, update NFT counters accordingly
-        """
-        while True:
-            n = 0
-            print("Refreshing staked nodes")
-            contact_infos = await get_contact_infos()
-            new_staked = await get_staked_nodes()
-
-            new_nodes = set(new_staked) - set(self.staked_nodes)
-            to_remove_nodes = set(self.staked_nodes) - set(new_staked)
-            for pk in to_remove_nodes:
-                print(f"Removing node {pk} from monitored set")
-                self.staked_nodes.pop(pk)
-                # TODO: use to_remove_nodes to clean out dead counters in nftables
-                # may need named counters for that
-
-            # do not add too many conuters all at once to avoid blocking event loop
-            while len(new_nodes) > 10:
-                new_nodes.pop()
-
-            for pk in new_nodes:
-                ip = contact_infos[pk]
-                self.staked_nodes[pk] = StakedNode(
-                    stake=new_staked[pk],
-                    ip_address=ip,
-                    pubkey=pk,
-                    packet_count=0,
+        self.decision_timestamp = time.time()
+
+    def set_decision_reason(self, reason: str) -> None:
+        if reason != self.decision_reason:
+            self.decision_reason = reason
+            self.decision_timestamp = time.time()
+            if self.journal is not None:
+                self.journal.event(self.name, reason)
+
+    def status(self) -> InstanceStatus:
+        return InstanceStatus(
+            name=self.name,
+            decision_reason=self.decision_reason,
+            decision_timestamp=self.decision_timestamp,
+            stake_threshold=self.stake_threshold,
+            connections=[
+                connection_status(
+                    name=conn.name,
+                    ip_address=conn.ip_address,
+                    is_active=conn == self.connection,
+                    records=conn.health_records,
+                    grace_period=self.grace_period_sec,
                 )
-                n += 1
-                print(f"Add counter for {ip}")
-                nft_add_counter(ip)
-            print(f"Added {n} counters")
-            await asyncio.sleep(self.node_refresh_interval_seconds)
+                for conn in self.connections
+            ],
+        )
 
-    async def passive_monitoring(self) -> None:
+    async def passive_monitoring(self, shared: SharedState) -> None:
         """
         Check NFT counters for incoming traffic on active connections to check their health
         """
         while True:
-            counters = get_nft_counters()
+            await shared.wait_counters()
             reachable_stake = 0
             unreachable_stake = 0
-            for pk, node in self.staked_nodes.items():
-                cnt = counters.get(node.ip_address, 0)
-                diff = cnt - node.packet_count
-                node.packet_count = cnt
-                if diff > 0:
-                    reachable_stake += node.stake / LAMPORTS_PER_SOL
-                else:
-                    unreachable_stake += node.stake / LAMPORTS_PER_SOL
+            for node in shared.staked_nodes.values():
+                score = shared.reachability(node, self.connection.ip_address)
+                reachable_stake += score * node.stake / LAMPORTS_PER_SOL
+                unreachable_stake += (1 - score) * node.stake / LAMPORTS_PER_SOL
             rec = HealthRecord(
                 reachable_stake_fraction=reachable_stake
                 / (1 + reachable_stake + unreachable_stake)
             )
             print(
-                f"Passive monitoring of {self.connection.name}: reachable stake {reachable_stake}, unreachable stake: {unreachable_stake} (quality={rec.reachable_stake_fraction:.1%})"
+                f"[{self.name}] Passive monitoring of {self.connection.name}: reachable stake {reachable_stake}, unreachable stake: {unreachable_stake} (quality={rec.reachable_stake_fraction:.1%})"
+            )
+            print(
+                f"[{self.name}] Traffic: {format_traffic_rates(shared.traffic_rates(self.connection.ip_address))}"
             )
             self.connection.health_records.append(rec)
-            await asyncio.sleep(self.passive_monitoring_interval_seconds)
+            if self.journal is not None:
+                self.journal.tick(
+                    self.name,
+                    rec.reachable_stake_fraction,
+                    shared,
+                    dest=self.connection.ip_address,
+                )
 
-    async def main(self) -> None:
+    async def main(self, shared: SharedState, journal: Journal) -> None:
+        self.journal = journal
         async with task_group.TaskGroup() as tg:
-            tg.create_task(self.refresh_staked_nodes())
-            tg.create_task(self.passive_monitoring())
-            tg.create_task(self.active_monitoring())
+            tg.create_task(self.passive_monitoring(shared))
+            tg.create_task(self.active_monitoring(shared))
             tg.create_task(self.decision())
 
+    async def select_active_interface(self) -> None:
+        """Ask the validator to switch to the current connection via admin RPC"""
+        request = json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "method": "selectActiveInterface",
+                "params": [str(self.connection.ip_address)],
+                "id": 1,
+            }
+        )
+        writer = None
+        try:
+            # Connect to the socket file
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(self.admin_rpc_path),
+                self.admin_rpc_timeout_seconds,
+            )
+
+            # Send the string as bytes
+            writer.write(request.encode("utf-8"))
+            await asyncio.wait_for(writer.drain(), self.admin_rpc_timeout_seconds)
+            print(f"[{self.name}] Admin RPC request {request} sent successfully.")
+            response = await asyncio.wait_for(
+                reader.read(500), self.admin_rpc_timeout_seconds
+            )
+            print(f"[{self.name}] Received response {response}")
+        except (OSError, asyncio.TimeoutError) as e:
+            # e.g. validator restarting, this must not affect other instances
+            print(f"[{self.name}] Admin RPC request failed, error {e!r}")
+            self.set_decision_reason(
+                f"Admin RPC failed switching to {self.connection.name}"
+            )
+        finally:
+            if writer is not None:
+                writer.close()
+
     async def decision(self) -> None:
         """
         Goes over the connections ensuring we are using the "best" one.
@@ -240,42 +279,48 @@ class Monitor:
                         live_connections.append(conn)
 
             live_connections.sort(key=lambda c: c.preference)
-            if self.connection != live_connections[-1]:
+            if live_connections and self.connection != live_connections[-1]:
                 self.connection = live_connections[-1]
-                print(f"Switching to preferred connection {self.connection.name}")
-                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                request = f'{"jsonrpc": "2.0", "method": "selectActiveInterface", "params": [{self.connection.ip_address}], "id": 1}'
-                try:
-                    # Connect to the socket file
-                    client.connect(ADMIN_RPC_PATH)
-
-                    # Send the string as bytes
-                    client.sendall(request.encode("utf-8"))
-                    print("Admin RPC request {request} sent successfully.")
-                    response = client.recv(500)
-                    print(f"Received response {response}")
-
-                finally:
-                    client.close()
+                print(
+                    f"[{self.name}] Switching to preferred connection {self.connection.name}"
+                )
+                self.set_decision_reason(
+                    f"Switched to preferred connection {self.connection.name}"
+                )
+                await self.select_active_interface()
 
                 await asyncio.sleep(self.switch_debounce_seconds)
             elif self.connection not in live_connections:
-                print("Current connection is DEAD")
+                print(f"[{self.name}] Current connection is DEAD")
                 if not live_connections:
                     if self.connection != self.connections[0]:
-                        print("No connections are good, switching to default")
+                        print(
+                            f"[{self.name}] No connections are good, switching to default"
+                        )
                         self.connection = self.connections[0]
+                        self.set_decision_reason(
+                            "No connections are good, switched to default"
+                        )
                         # TODO: emit signal as appropriate
                         await asyncio.sleep(self.switch_debounce_seconds)
+                    else:
+                        self.set_decision_reason(
+                            "No connections are good, staying on default"
+                        )
                 else:
                     self.connection = live_connections[-1]
-                    print(f"Switching to {self.connection.name}")
+                    print(f"[{self.name}] Switching to {self.connection.name}")
+                    self.set_decision_reason(
+                        f"Previous connection dead, switched to {self.connection.name}"
+                    )
                     # TODO: emit signal as appropriate
                     await asyncio.sleep(self.switch_debounce_seconds)
+            else:
+                self.set_decision_reason(f"Keeping {self.connection.name}")
 
             await asyncio.sleep(self.decision_check_interval_seconds)
 
-    async def active_monitoring(self) -> None:
+    async def active_monitoring(self, shared: SharedState) -> None:
         """
         Monitor connection quality by actively pinging hosts
         This is needed when connection is not active and no traffic can be expected
@@ -288,35 +333,53 @@ class Monitor:
                 if self.connection == conn:
                     continue
 
-                tasks = []
-                stakes = []
-                for v in self.staked_nodes.values():
-                    tasks.append(ping.ping(bind=conn.ip_address, host=v.ip_address))
-                    stakes.append(v.stake)
-
-                # TODO: cascade these properly
-                ping_results = await asyncio.gather(*tasks)
+                # pings are shared with other instances using the same bind IP
+                ping_results = await shared.probe(conn.ip_address)
                 reachable_stake = 0
                 unreachable_stake = 0
-                for pr, stake in zip(ping_results, stakes):
-                    if pr:
-                        reachable_stake += stake / LAMPORTS_PER_SOL
+                for pk, v in shared.staked_nodes.items():
+                    if ping_results.get(pk, False):
+                        reachable_stake += v.stake / LAMPORTS_PER_SOL
                     else:
-                        unreachable_stake += stake / LAMPORTS_PER_SOL
+                        unreachable_stake += v.stake / LAMPORTS_PER_SOL
 
                 rec = HealthRecord(
                     reachable_stake_fraction=reachable_stake
                     / (1 + reachable_stake + unreachable_stake)
                 )
                 print(
-                    f"Active monitoring of {conn.name}: reachable stake {reachable_stake}, unreachable stake: {unreachable_stake} (quality={rec.reachable_stake_fraction:.1%})"
+                    f"[{self.name}] Active monitoring of {conn.name}: reachable stake {reachable_stake}, unreachable stake: {unreachable_stake} (quality={rec.reachable_stake_fraction:.1%})"
                 )
                 conn.health_records.append(rec)
 
-            await asyncio.sleep(self.active_monitoring_interval_seconds)
+            await asyncio.sleep(shared.active_monitoring_interval_seconds)
+
+
+async def run_instance(mon: Monitor, shared: SharedState, journal: Journal) -> None:
+    """Run one instance, a crash of it must not take down the other instances"""
+    try:
+        await mon.main(shared, journal)
+    except Exception:
+        print(f"[{mon.name}] Monitoring of this instance crashed")
+        print_exc()
+
+
+async def run(
+    shared: SharedState, page: StatusPage, journal: Journal, monitors: list[Monitor]
+) -> None:
+    """Run the shared cluster/counter/probe tasks together with all monitored instances"""
+    async with task_group.TaskGroup() as tg:
+        tg.create_task(shared.main())
+        tg.create_task(journal.main())
+        tg.create_task(publish_status(page, shared, monitors))
+        tg.create_task(QueryServer(QUERY_SOCKET_PATH, shared, monitors).main())
+        for mon in monitors:
+            tg.create_task(run_instance(mon, shared, journal))
 
 
 if __name__ == "__main__":
-    connections = get_config()
-    with Monitor(connections) as mon:
-        asyncio.run(mon.main())
+    monitors = get_config()
+    bind_ips = {conn.ip_address for mon in monitors for conn in mon.connections}
+    with SharedState(bind_ips) as shared, StatusPage(STATUS_PAGE_PATH) as page:
+        with Journal(JOURNAL_DIR) as journal:
+            asyncio.run(run(shared, page, journal, monitors))
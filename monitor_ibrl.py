@@ -8,14 +8,15 @@ import task_group
 import time
 from config import *
 from helpers import *
-
-
-@dataclasses.dataclass
-class StakedNode:
-    pubkey: str
-    ip_address: ipaddress.IPv4Address
-    stake: int
-    packet_count: int
+from journal import Journal
+from shared import SharedState
+from status import (
+    InstanceStatus,
+    QueryServer,
+    StatusPage,
+    connection_status,
+    publish_status,
+)
 
 
 @dataclasses.dataclass
@@ -66,69 +67,78 @@ class DZConnection:
         return ip in self.reachable_ips
 
 
+class DZSharedState(SharedState):
+    """Only tracks counters for nodes reachable over DZ"""
+
+    connection: DZConnection
+
+    def __init__(self, connection: DZConnection) -> None:
+        super().__init__(
+            bind_ips={None},
+            passive_monitoring_interval_seconds=PASSIVE_MONITORING_INTERVAL_SECONDS,
+        )
+        self.connection = connection
+
+    async def update_filter(self) -> None:
+        await self.connection.update_reachable_nodes()
+
+    def is_wanted(self, ip: ipaddress.IPv4Address) -> bool:
+        # we only want to track counters for DZ-reachable nodes
+        return self.connection.is_reachable(ip)
+
+
 class Monitor:
-    staked_nodes: dict[str, StakedNode] = {}
     connection: DZConnection
+    shared: DZSharedState
+    page: StatusPage
+    journal: Journal
+    # whether doublezero0 was up at last check
+    dz_up: bool = True
+    # last decision made and when it was first made, published on the status page
+    decision_reason: str = "Warming up"
+    decision_timestamp: float
 
     def __init__(self) -> None:
         self.connection = DZConnection()
+        self.shared = DZSharedState(self.connection)
+        self.page = StatusPage(STATUS_PAGE_PATH)
+        self.journal = Journal(JOURNAL_DIR)
+        self.decision_timestamp = time.time()
 
     def __enter__(self):
-        print("Setting up nftables")
-        nft_add_table()
+        self.shared.__enter__()
+        self.page.__enter__()
+        self.journal.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        print("Cleaning up")
-        nft_drop_table()
-
-    async def refresh_staked_nodes(self):
-        """
-        Refresh list of staked nodes, update NFT counters accordingly
-        """
-        while True:
-            print("Refreshing staked nodes")
-            contact_infos = await get_contact_infos()
-            new_staked = await get_staked_nodes()
-
-            await self.connection.update_reachable_nodes()
-
-            new_nodes = set(new_staked) - set(self.staked_nodes)
-            for pk in new_nodes.copy():
-                ip = contact_infos.get(pk)
-                if ip is None:
-                    new_nodes.remove(pk)
-                # we only want to track stuff for DZ-reachable nodes
-                elif not self.connection.is_reachable(ip):
-                    new_nodes.remove(pk)
-
-            to_remove_nodes = set(self.staked_nodes) - set(new_staked)
-            for pk in to_remove_nodes:
-                print(f"Removing node {pk} from monitored set")
-                node = self.staked_nodes.pop(pk)
-                # try to clean the counter in nftables
-                nft_del_counter(node.ip_address)
-
-            added = 0
-            for pk in new_nodes:
-                ip = contact_infos[pk]
-                # we only want to track counters for DZ-reachable nodes
-                if not self.connection.is_reachable(ip):
-                    continue
-                self.staked_nodes[pk] = StakedNode(
-                    stake=new_staked[pk],
-                    ip_address=ip,
-                    pubkey=pk,
-                    packet_count=0,
+        self.journal.__exit__(exc_type, exc_value, traceback)
+        self.page.__exit__(exc_type, exc_value, traceback)
+        self.shared.__exit__(exc_type, exc_value, traceback)
+
+    def set_decision_reason(self, reason: str) -> None:
+        if reason != self.decision_reason:
+            self.decision_reason = reason
+            self.decision_timestamp = time.time()
+            self.journal.event("ibrl", reason)
+
+    def status(self) -> InstanceStatus:
+        return InstanceStatus(
+            name="ibrl",
+            decision_reason=self.decision_reason,
+            decision_timestamp=self.decision_timestamp,
+            stake_threshold=STAKE_THRESHOLD,
+            connections=[
+                connection_status(
+                    name="DoubleZero",
+                    # IBRL does not bind to a particular address
+                    ip_address=ipaddress.IPv4Address(0),
+                    is_active=self.dz_up,
+                    records=self.connection.health_records,
+                    grace_period=GRACE_PERIOD_SEC,
                 )
-                print(f"Add counter for {ip}")
-                nft_add_counter(ip)
-                added += 1
-                # do not add too many conuters all at once to avoid blocking event loop
-                if added >= 10:
-                    break
-            print(f"Added {added}, removed {len(to_remove_nodes)} counters")
-            await asyncio.sleep(NODE_REFRESH_INTERVAL_SECONDS)
+            ],
+        )
 
     async def passive_monitoring(self) -> None:
         """
@@ -136,25 +146,21 @@ class Monitor:
         """
         dead_nodes: defaultdict[str, int] = defaultdict(int)
         while True:
-            await asyncio.sleep(PASSIVE_MONITORING_INTERVAL_SECONDS)
-            counters = get_nft_counters()
+            await self.shared.wait_counters()
             reachable_stake = 0.0
             unreachable_stake = 0.0
-            for pk, node in self.staked_nodes.items():
-                cnt = counters.get(node.ip_address, 0)
-                diff = cnt - node.packet_count
-                node.packet_count = cnt
+            for pk, node in self.shared.staked_nodes.items():
                 if not self.connection.is_reachable(node.ip_address):
                     continue
 
                 if node.stake == 0:
                     print(node)
                     raise RuntimeError()
-                if diff > 0:
-                    reachable_stake += node.stake / LAMPORTS_PER_SOL
-                else:
+                score = self.shared.reachability(node)
+                reachable_stake += score * node.stake / LAMPORTS_PER_SOL
+                unreachable_stake += (1 - score) * node.stake / LAMPORTS_PER_SOL
+                if score < 1.0:
                     dead_nodes[pk] += 1
-                    unreachable_stake += node.stake / LAMPORTS_PER_SOL
             if unreachable_stake == 0.0 and reachable_stake == 0.0:
                 print("No stake from DZ captured in counters...")
                 continue
@@ -165,14 +171,28 @@ class Monitor:
             print(
                 f"Monitoring: stake reachable {int(reachable_stake)}/{int(reachable_stake + unreachable_stake)} ({rec.reachable_stake_fraction:.1%})"
             )
+            print(f"Traffic: {format_traffic_rates(self.shared.traffic_rates())}")
             self.connection.health_records.append(rec)
+            self.journal.tick(
+                "ibrl",
+                rec.reachable_stake_fraction,
+                self.shared,
+                nodes=[
+                    node
+                    for node in self.shared.staked_nodes.values()
+                    if self.connection.is_reachable(node.ip_address)
+                ],
+            )
             if rec.reachable_stake_fraction < STAKE_THRESHOLD:
                 print(f"missing packet counts per node: {dict(dead_nodes)}")
                 dead_nodes.clear()
 
     async def main(self) -> None:
         async with task_group.TaskGroup() as tg:
-            tg.create_task(self.refresh_staked_nodes())
+            tg.create_task(self.shared.main())
+            tg.create_task(self.journal.main())
+            tg.create_task(publish_status(self.page, self.shared, [self]))
+            tg.create_task(QueryServer(QUERY_SOCKET_PATH, self.shared, [self]).main())
             tg.create_task(self.passive_monitoring())
             tg.create_task(self.decision())
 
@@ -186,16 +206,24 @@ class Monitor:
             await asyncio.sleep(PASSIVE_MONITORING_INTERVAL_SECONDS)
 
             # check for obvious issues
-            if not await self.connection.self_check():
+            self.dz_up = await self.connection.self_check()
+            if not self.dz_up:
                 print("DZ already disabled")
+                self.set_decision_reason("DZ already disabled")
                 continue
 
             # check if we can still reach target % of stake
             if self.connection.get_best_in_period(GRACE_PERIOD_SEC) < STAKE_THRESHOLD:
                 print("Failure condition detected: Disconnecting DZ")
                 kill_dz_interface()
+                self.dz_up = False
+                self.set_decision_reason(
+                    "Reachable stake below threshold, disconnected DZ"
+                )
+                self.page.write([self.status()])
                 print(self.connection.health_records)
                 exit(1)
+            self.set_decision_reason("DZ healthy")
 
 
 if __name__ == "__main__":
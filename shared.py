@@ -0,0 +1,244 @@
+import asyncio
+import dataclasses
+import ipaddress
+import time
+from typing import Any, Optional
+import ping
+import task_group
+from config import *
+from helpers import *
+
+
+@dataclasses.dataclass
+class StakedNode:
+    pubkey: str
+    ip_address: ipaddress.IPv4Address
+    stake: int
+
+
+class SharedState:
+    """
+    State shared between all monitored instances on the host:
+    list of staked nodes, nftables counters and results of active probes.
+    Each of these is fetched once per host regardless of how many
+    instances are monitored.
+    """
+
+    staked_nodes: dict[str, StakedNode]
+    # Destination addresses we keep counters for, None matches any address
+    bind_ips: set[Optional[ipaddress.IPv4Address]]
+    # Last seen values of counters and their increase over the last interval
+    counters: dict[CounterKey, Counter]
+    deltas: dict[CounterKey, Counter]
+    # Actual length of the last interval between counter reads
+    deltas_interval_seconds: float
+    # Destination ports matched by each traffic class
+    ports: dict[str, set[int]]
+    # Results of last probe run per bind IP as (timestamp, {pubkey: reachable})
+    probe_results: dict[ipaddress.IPv4Address, tuple[float, dict[str, bool]]]
+    passive_monitoring_interval_seconds: float = 1.0
+    active_monitoring_interval_seconds: float = 10.0
+    # Interval between refreshes of gossip tables via RPC
+    node_refresh_interval_seconds: float = NODE_REFRESH_INTERVAL_SECONDS
+
+    def __init__(
+        self,
+        bind_ips: set[Optional[ipaddress.IPv4Address]],
+        passive_monitoring_interval_seconds: Optional[float] = None,
+    ) -> None:
+        self.staked_nodes = {}
+        self.bind_ips = bind_ips
+        self.counters = {}
+        self.deltas = {}
+        self.deltas_interval_seconds = self.passive_monitoring_interval_seconds
+        self.probe_results = {}
+        self.ports = {}
+        self._probe_locks: dict[ipaddress.IPv4Address, asyncio.Lock] = {}
+        self._counters_updated: Optional[asyncio.Event] = None
+        if passive_monitoring_interval_seconds is not None:
+            self.passive_monitoring_interval_seconds = (
+                passive_monitoring_interval_seconds
+            )
+
+    def __enter__(self):
+        print("Setting up nftables")
+        nft_add_table(by_dest=self.bind_ips != {None})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        print("Cleaning up")
+        nft_drop_table()
+
+    async def update_filter(self) -> None:
+        """Called before every refresh of staked nodes, override to update what is_wanted checks"""
+        pass
+
+    def is_wanted(self, ip: ipaddress.IPv4Address) -> bool:
+        """Whether we want to track counters for node with given IP"""
+        return True
+
+    def update_ports(self, cluster_nodes: list[dict[str, Any]]) -> None:
+        """Match traffic classes on the ports the local validators advertise"""
+        local_ips = {ip if ip is not None else get_default_ip() for ip in self.bind_ips}
+        ports = get_local_ports(cluster_nodes, local_ips)
+        if ports is None:
+            # RPC failed or our validators are not in gossip (yet), keep last known ports
+            print(
+                "Could not find local validators in cluster nodes, keeping traffic class ports"
+            )
+            return
+        if ports != self.ports:
+            print(f"Traffic class ports: {ports}")
+            nft_set_ports(ports)
+            self.ports = ports
+
+    async def refresh_staked_nodes(self) -> None:
+        """
+        Refresh list of staked nodes, update NFT counters accordingly
+        """
+        while True:
+            print("Refreshing staked nodes")
+            cluster_nodes = await get_cluster_nodes()
+            contact_infos = get_contact_infos(cluster_nodes)
+            new_staked = await get_staked_nodes()
+            self.update_ports(cluster_nodes)
+
+            await self.update_filter()
+
+            new_nodes = set(new_staked) - set(self.staked_nodes)
+            for pk in new_nodes.copy():
+                ip = contact_infos.get(pk)
+                if ip is None or not self.is_wanted(ip):
+                    new_nodes.remove(pk)
+
+            to_remove_nodes = set(self.staked_nodes) - set(new_staked)
+            for pk in to_remove_nodes:
+                print(f"Removing node {pk} from monitored set")
+                node = self.staked_nodes.pop(pk)
+                # try to clean the counters in nftables
+                for dest in self.bind_ips:
+                    nft_del_counter(node.ip_address, dest)
+                for key in [k for k in self.counters if k[0] == node.ip_address]:
+                    self.counters.pop(key)
+
+            added = 0
+            for pk in new_nodes:
+                ip = contact_infos[pk]
+                self.staked_nodes[pk] = StakedNode(
+                    stake=new_staked[pk],
+                    ip_address=ip,
+                    pubkey=pk,
+                )
+                print(f"Add counters for {ip}")
+                for dest in self.bind_ips:
+                    nft_add_counter(ip, dest)
+                added += 1
+                # do not add too many conuters all at once to avoid blocking event loop
+                if added >= 10:
+                    break
+            print(f"Added {added}, removed {len(to_remove_nodes)} nodes")
+            await asyncio.sleep(self.node_refresh_interval_seconds)
+
+    async def read_counters(self) -> None:
+        """
+        Read NFT counters once per interval and publish the increase
+        since previous read to all waiting instances
+        """
+        last_read = time.monotonic()
+        while True:
+            await asyncio.sleep(self.passive_monitoring_interval_seconds)
+            counters = get_nft_counters()
+            now = time.monotonic()
+            deltas: dict[CounterKey, Counter] = {}
+            for key, cnt in counters.items():
+                deltas[key] = cnt - self.counters.get(key, Counter())
+            self.counters = counters
+            self.deltas = deltas
+            self.deltas_interval_seconds = now - last_read
+            last_read = now
+            if self._counters_updated is not None:
+                self._counters_updated.set()
+                self._counters_updated = None
+
+    async def wait_counters(self) -> dict[CounterKey, Counter]:
+        """Wait for the next counter read and return the increase of counters over last interval"""
+        if self._counters_updated is None:
+            self._counters_updated = asyncio.Event()
+        await self._counters_updated.wait()
+        return self.deltas
+
+    def traffic_from(
+        self, node: StakedNode, dest: Optional[ipaddress.IPv4Address] = None
+    ) -> dict[str, Counter]:
+        """
+        Traffic received from node in the last interval per traffic class,
+        traffic not matching any class is reported as OTHER_TRAFFIC
+        """
+        traffic = {
+            cls: self.deltas.get((node.ip_address, dest, cls), Counter())
+            for cls in TRAFFIC_CLASSES
+        }
+        other = self.deltas.get((node.ip_address, dest, ALL_TRAFFIC), Counter())
+        for cnt in traffic.values():
+            other -= cnt
+        traffic[OTHER_TRAFFIC] = other
+        return traffic
+
+    def reachability(
+        self, node: StakedNode, dest: Optional[ipaddress.IPv4Address] = None
+    ) -> float:
+        """
+        How reachable node was in the last interval, from 0 to 1.
+        Weights of traffic classes which saw packets are summed and capped at 1.
+        """
+        score = 0.0
+        for cls, cnt in self.traffic_from(node, dest).items():
+            if cnt.packets > 0:
+                score += TRAFFIC_CLASS_WEIGHTS.get(cls, 0.0)
+        return min(score, 1.0)
+
+    def traffic_rates(
+        self, dest: Optional[ipaddress.IPv4Address] = None
+    ) -> dict[str, tuple[float, float]]:
+        """Packet and byte rates per second from all staked nodes in the last interval per traffic class"""
+        totals: dict[str, Counter] = {}
+        for (_source, d, cls), cnt in self.deltas.items():
+            if d != dest:
+                continue
+            totals[cls] = totals.get(cls, Counter()) + cnt
+        return {
+            cls: (
+                cnt.packets / self.deltas_interval_seconds,
+                cnt.bytes / self.deltas_interval_seconds,
+            )
+            for cls, cnt in totals.items()
+        }
+
+    async def probe(self, bind: ipaddress.IPv4Address) -> dict[str, bool]:
+        """
+        Ping all staked nodes from given bind IP and return reachability per node.
+        Results are cached for the active monitoring interval, so instances
+        sharing a bind IP share the pings.
+        """
+        lock = self._probe_locks.setdefault(bind, asyncio.Lock())
+        async with lock:
+            cached = self.probe_results.get(bind)
+            if (
+                cached is not None
+                and time.time() - cached[0] < self.active_monitoring_interval_seconds
+            ):
+                return cached[1]
+
+            nodes = list(self.staked_nodes.values())
+            # TODO: cascade these properly
+            ping_results = await asyncio.gather(
+                *[ping.ping(bind=bind, host=v.ip_address) for v in nodes]
+            )
+            results = {v.pubkey: pr for v, pr in zip(nodes, ping_results)}
+            self.probe_results[bind] = (time.time(), results)
+            return results
+
+    async def main(self) -> None:
+        async with task_group.TaskGroup() as tg:
+            tg.create_task(self.refresh_staked_nodes())
+            tg.create_task(self.read_counters())
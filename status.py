@@ -0,0 +1,408 @@
+#!/usr/bin/python3
+"""
+Publishes state of the monitor for external consumers.
+
+The status page is a fixed-layout file which is memory-mapped by the monitor and
+can be memory-mapped by any number of readers, which can then poll it without
+talking to the monitor at all. Layout (little endian):
+
+    header:   magic "DZMS", u16 version, u8 instance count, u8 flags, u64 sequence,
+              f64 update time
+    instance: 32s name, 64s last decision reason, f64 decision time, f32 stake threshold,
+              i8 active connection index (-1 if none), u8 connection count, 2 pad bytes
+    connection: 32s name, 4s IPv4 address, u8 is active, 3 pad bytes,
+                f32 last, best in grace period, mean and worst over kept history
+                of reachable stake fraction
+
+There are MAX_INSTANCES instance slots each followed by MAX_CONNECTIONS connection slots.
+Sequence is odd while the page is being written, readers should retry
+if it is odd or changed while they were reading. Flag FLAG_STOPPED is set
+when the monitor exited, the page then holds its final state.
+
+The query socket accepts one JSON request per line and replies with one JSON line:
+    {"method": "status"}                 same data as the status page
+    {"method": "nodes"}                  per-node detail for all staked nodes
+    {"method": "node", "pubkey": "..."}  per-node detail for one node
+"""
+import asyncio
+import dataclasses
+import ipaddress
+import json
+import mmap
+import os
+import shutil
+import stat
+import struct
+import sys
+import time
+from collections.abc import Iterable
+from traceback import print_exc
+from typing import Any, Optional
+from config import *
+from helpers import *
+from shared import SharedState, StakedNode
+
+MAGIC = b"DZMS"
+VERSION = 2
+MAX_INSTANCES = 16
+MAX_CONNECTIONS = 4
+FLAG_STOPPED = 1
+
+HEADER = struct.Struct("<4sHBBQd")
+INSTANCE = struct.Struct("<32s64sdfbB2x")
+CONNECTION = struct.Struct("<32s4sB3xffff")
+INSTANCE_SLOT_SIZE = INSTANCE.size + MAX_CONNECTIONS * CONNECTION.size
+PAGE_SIZE = HEADER.size + MAX_INSTANCES * INSTANCE_SLOT_SIZE
+
+
+@dataclasses.dataclass
+class ConnectionStatus:
+    name: str
+    ip_address: ipaddress.IPv4Address
+    is_active: bool
+    # reachable stake fraction: last sample, best in grace period,
+    # mean and worst over all kept health records
+    last: float
+    best_in_grace_period: float
+    mean: float
+    worst: float
+
+
+@dataclasses.dataclass
+class InstanceStatus:
+    name: str
+    decision_reason: str
+    decision_timestamp: float
+    stake_threshold: float
+    connections: list[ConnectionStatus]
+
+    @property
+    def active_connection(self) -> Optional[ConnectionStatus]:
+        for conn in self.connections:
+            if conn.is_active:
+                return conn
+        return None
+
+
+@dataclasses.dataclass
+class PageStatus:
+    updated: float
+    # monitor exited, instances hold its final state
+    stopped: bool
+    # page was not updated within max_age
+    stale: bool
+    instances: list[InstanceStatus]
+
+
+def connection_status(
+    name: str,
+    ip_address: ipaddress.IPv4Address,
+    is_active: bool,
+    records: Iterable[Any],
+    grace_period: float,
+) -> ConnectionStatus:
+    """Summarize health records (anything with reachable_stake_fraction and timestamp)"""
+    now = time.time()
+    fractions = [r.reachable_stake_fraction for r in records]
+    in_grace = [
+        r.reachable_stake_fraction for r in records if now - r.timestamp < grace_period
+    ]
+    return ConnectionStatus(
+        name=name,
+        ip_address=ip_address,
+        is_active=is_active,
+        last=fractions[-1] if fractions else 0.0,
+        best_in_grace_period=max(in_grace, default=0.0),
+        mean=sum(fractions) / len(fractions) if fractions else 0.0,
+        worst=min(fractions, default=0.0),
+    )
+
+
+class StatusPage:
+    """Writer side of the memory-mapped status page"""
+
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # set to False if the page could not be created
+        self.enabled = True
+        self._buf = bytearray(PAGE_SIZE - HEADER.size)
+        self._seq = 0
+        self._instances: list[InstanceStatus] = []
+
+    def __enter__(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+            # never follow a symlink someone may have planted in place of the page
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+            try:
+                os.ftruncate(fd, PAGE_SIZE)
+                self._mm = mmap.mmap(fd, PAGE_SIZE)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"Could not create status page, status page disabled, error {e}")
+            self.enabled = False
+            return self
+        print(f"Publishing status page at {self.path}")
+        self.write([])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+        # keep the file around with the final state marked as such
+        self.write(self._instances, flags=FLAG_STOPPED)
+        self._mm.close()
+        self.enabled = False
+
+    def write(self, instances: list[InstanceStatus], flags: int = 0) -> None:
+        if not self.enabled:
+            return
+        self._instances = instances
+        buf = self._buf
+        buf[:] = bytes(len(buf))
+        for i, inst in enumerate(instances[:MAX_INSTANCES]):
+            offset = i * INSTANCE_SLOT_SIZE
+            conns = inst.connections[:MAX_CONNECTIONS]
+            active = next((n for n, c in enumerate(conns) if c.is_active), -1)
+            INSTANCE.pack_into(
+                buf,
+                offset,
+                inst.name.encode()[:32],
+                inst.decision_reason.encode()[:64],
+                inst.decision_timestamp,
+                inst.stake_threshold,
+                active,
+                len(conns),
+            )
+            offset += INSTANCE.size
+            for conn in conns:
+                CONNECTION.pack_into(
+                    buf,
+                    offset,
+                    conn.name.encode()[:32],
+                    conn.ip_address.packed,
+                    conn.is_active,
+                    conn.last,
+                    conn.best_in_grace_period,
+                    conn.mean,
+                    conn.worst,
+                )
+                offset += CONNECTION.size
+
+        # seqlock: odd sequence tells readers the page is being updated
+        self._seq += 1
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, 0, 0, self._seq, time.time())
+        self._mm[HEADER.size :] = buf
+        self._seq += 1
+        HEADER.pack_into(
+            self._mm,
+            0,
+            MAGIC,
+            VERSION,
+            min(len(instances), MAX_INSTANCES),
+            flags,
+            self._seq,
+            time.time(),
+        )
+
+
+def parse_status(
+    page: bytes, max_age: float = STATUS_PAGE_MAX_AGE_SECONDS
+) -> PageStatus:
+    """Decode a consistent copy of the status page"""
+    magic, version, count, flags, _seq, updated = HEADER.unpack_from(page, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a status page of version {VERSION}")
+    instances: list[InstanceStatus] = []
+    for i in range(count):
+        offset = HEADER.size + i * INSTANCE_SLOT_SIZE
+        name, reason, reason_time, threshold, _active, n_conns = INSTANCE.unpack_from(
+            page, offset
+        )
+        offset += INSTANCE.size
+        conns: list[ConnectionStatus] = []
+        for _ in range(n_conns):
+            cname, ip, is_active, last, best, mean, worst = CONNECTION.unpack_from(
+                page, offset
+            )
+            conns.append(
+                ConnectionStatus(
+                    name=cname.rstrip(b"\0").decode(errors="replace"),
+                    ip_address=ipaddress.IPv4Address(ip),
+                    is_active=bool(is_active),
+                    last=last,
+                    best_in_grace_period=best,
+                    mean=mean,
+                    worst=worst,
+                )
+            )
+            offset += CONNECTION.size
+        instances.append(
+            InstanceStatus(
+                name=name.rstrip(b"\0").decode(errors="replace"),
+                decision_reason=reason.rstrip(b"\0").decode(errors="replace"),
+                decision_timestamp=reason_time,
+                stake_threshold=threshold,
+                connections=conns,
+            )
+        )
+    return PageStatus(
+        updated=updated,
+        stopped=bool(flags & FLAG_STOPPED),
+        stale=time.time() - updated > max_age,
+        instances=instances,
+    )
+
+
+def read_status(
+    mm: mmap.mmap, retries: int = 100, max_age: float = STATUS_PAGE_MAX_AGE_SECONDS
+) -> PageStatus:
+    """
+    Read the memory-mapped status page, retrying while the monitor is writing it.
+    Pages older than max_age are returned marked stale, the last state of a hung
+    or exited monitor is still worth looking at. Raises TimeoutError if no consistent
+    copy could be read (e.g. the monitor died in the middle of an update).
+    """
+    for attempt in range(retries):
+        seq = HEADER.unpack_from(mm, 0)[4]
+        if seq % 2 == 0:
+            page = mm[:PAGE_SIZE]
+            if HEADER.unpack_from(mm, 0)[4] == seq:
+                return parse_status(page, max_age)
+        # writer updates take microseconds, back off a little and try again
+        time.sleep(0.0001 * min(2**attempt, 100))
+    raise TimeoutError("Could not get a consistent copy of the status page")
+
+
+async def publish_status(
+    page: StatusPage, shared: SharedState, monitors: list[Any]
+) -> None:
+    """Update the status page after every counter read, monitors must provide status()"""
+    while True:
+        await shared.wait_counters()
+        try:
+            page.write([mon.status() for mon in monitors])
+        except Exception:
+            print_exc()
+
+
+def node_detail(shared: SharedState, node: StakedNode) -> dict[str, Any]:
+    traffic: dict[str, Any] = {}
+    reachability: dict[str, float] = {}
+    for dest in shared.bind_ips:
+        key = "any" if dest is None else str(dest)
+        traffic[key] = {
+            cls: dataclasses.asdict(cnt)
+            for cls, cnt in shared.traffic_from(node, dest).items()
+        }
+        reachability[key] = shared.reachability(node, dest)
+    probes = {
+        str(bind): results[node.pubkey]
+        for bind, (_ts, results) in shared.probe_results.items()
+        if node.pubkey in results
+    }
+    return {
+        "pubkey": node.pubkey,
+        "ip_address": str(node.ip_address),
+        "stake": node.stake,
+        "traffic": traffic,
+        "reachability": reachability,
+        "probes": probes,
+    }
+
+
+class QueryServer:
+    """Serves richer per-node detail over a Unix socket"""
+
+    path: str
+
+    def __init__(self, path: str, shared: SharedState, monitors: list[Any]) -> None:
+        self.path = path
+        self.shared = shared
+        self.monitors = monitors
+
+    def handle(self, req: dict[str, Any]) -> Any:
+        method = req.get("method")
+        if method == "status":
+            return [dataclasses.asdict(mon.status()) for mon in self.monitors]
+        if method == "nodes":
+            return [node_detail(self.shared, n) for n in self.shared.staked_nodes.values()]
+        if method == "node":
+            node = self.shared.staked_nodes.get(req.get("pubkey", ""))
+            if node is None:
+                raise ValueError(f"Unknown node {req.get('pubkey')}")
+            return node_detail(self.shared, node)
+        raise ValueError(f"Unknown method {method}")
+
+    async def serve_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    resp = {"result": self.handle(json.loads(line))}
+                except Exception as e:
+                    resp = {"error": str(e)}
+                # default=str takes care of IP addresses
+                writer.write(json.dumps(resp, default=str).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def main(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+            # only ever remove a stale socket of ours, not whatever else has that name
+            if os.path.lexists(self.path) and stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                os.unlink(self.path)
+            server = await asyncio.start_unix_server(self.serve_client, path=self.path)
+        except OSError as e:
+            print(f"Could not create query socket, queries disabled, error {e}")
+            return
+        print(f"Serving queries at {self.path}")
+        try:
+            if QUERY_SOCKET_GROUP is not None:
+                shutil.chown(self.path, group=QUERY_SOCKET_GROUP)
+            os.chmod(self.path, QUERY_SOCKET_MODE)
+        except Exception as e:
+            print(f"Could not set permissions of {self.path}, error {e}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                print(f"Could not remove {self.path}, error {e}")
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else STATUS_PAGE_PATH
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), PAGE_SIZE, access=mmap.ACCESS_READ)
+    try:
+        status = read_status(mm)
+    except (TimeoutError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    age = time.time() - status.updated
+    if status.stopped:
+        print(f"Monitor stopped {age:.1f}s ago, showing its final state")
+    elif status.stale:
+        print(f"Status page is stale, last updated {age:.0f}s ago, showing last state")
+    else:
+        print(f"Updated {age:.1f}s ago")
+    for inst in status.instances:
+        active = inst.active_connection
+        print(
+            f"{inst.name}: active {active.name if active else None}, last decision '{inst.decision_reason}'"
+        )
+        for conn in inst.connections:
+            print(
+                f"    {conn.name} ({conn.ip_address}): last {conn.last:.1%}, best in grace {conn.best_in_grace_period:.1%}, mean {conn.mean:.1%}, worst {conn.worst:.1%}"
+            )
+    if status.stopped or status.stale:
+        sys.exit(1)